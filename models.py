@@ -1,12 +1,17 @@
 # models.py
-import math
 import time
-from collections import Counter
+import zlib
 
 import nltk
 import numpy as np
+import scipy.sparse as sp
+from scipy.special import expit
 import spacy
-import random
+
+try:
+    from numba import njit
+except ImportError: # numba is optional, the perceptron just trains with the numpy loop without it
+    njit = None
 
 from sentiment_data import *
 from utils import *
@@ -20,19 +25,62 @@ class FeatureExtractor(object):
     def get_indexer(self):
         raise Exception("Don't call me, call my subclasses")
 
-    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> Counter:
+    def feature_dim(self) -> int:
+        """
+        :return: size of the feature space, i.e. how long the weight vector needs to be
+        """
+        return len(self.get_indexer())
+
+    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> np.ndarray:
         """
         Extract features from a sentence represented as a list of words. Includes a flag add_to_indexer to
         :param sentence: words in the example to featurize
         :param add_to_indexer: True if we should grow the dimensionality of the featurizer if new features are encountered.
         At test time, any unseen features should be discarded, but at train time, we probably want to keep growing it.
-        :return: A feature vector. We suggest using a Counter[int], which can encode a sparse feature vector (only
-        a few indices have nonzero value) in essentially the same way as a map. However, you can use whatever data
-        structure you prefer, since this does not interact with the framework code.
+        :return: The indices of the active features as an int32 numpy array, without repeats. Features are binary, so
+        this is all a sparse feature vector needs, and consumers can gather/scatter weights with it directly.
         """
         raise Exception("Don't call me, call my subclasses")
 
 
+def _index_features(indexer: Indexer, keys: List, add_to_indexer: bool) -> List[int]:
+    """
+    Maps feature keys to their indices with a single dict lookup per key.
+    :param indexer: Indexer holding the feature space
+    :param keys: feature keys (e.g. lowercased n-grams) extracted from a sentence
+    :param add_to_indexer: True if unseen keys should be added, False if they should be discarded
+    :return: list of feature indices, possibly with repeats
+    """
+    idx = indexer.objs_to_ints
+    if add_to_indexer:
+        add = indexer.add_and_get_index
+        return [i if (i := idx.get(key)) is not None else add(key) for key in keys]
+    return [i for i in map(idx.get, keys) if i is not None]
+
+
+def _binary_features(ids: List[int]) -> np.ndarray:
+    """
+    :param ids: feature indices, possibly with repeats
+    :return: the distinct indices, in first-seen order, as an int32 array (0 or 1 feature space)
+    """
+    distinct = dict.fromkeys(ids)
+    return np.fromiter(distinct, dtype=np.int32, count=len(distinct))
+
+
+def _token_ids(indexer: Indexer, tokens: List[str], add_to_indexer: bool) -> List[int]:
+    """
+    Maps tokens to integer ids position by position, so that adjacent ids can be packed into n-gram keys.
+    :param indexer: Indexer holding the token vocabulary
+    :param tokens: lowercased tokens of a sentence
+    :param add_to_indexer: True if unseen tokens should be added
+    :return: one id per token, -1 for unseen tokens when add_to_indexer is False
+    """
+    if add_to_indexer:
+        return list(map(indexer.add_and_get_index, tokens))
+    idx = indexer.objs_to_ints
+    return [idx.get(token, -1) for token in tokens]
+
+
 # FIXME: Part 1. PERCEPTRON
 class UnigramFeatureExtractor(FeatureExtractor):
     """
@@ -46,71 +94,92 @@ class UnigramFeatureExtractor(FeatureExtractor):
     def get_indexer(self):
         return self.indexer
 
-    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> Counter:
-        features = Counter()
-        for word in sentence:
-            word = word.lower() # lowercase
-            if self.indexer.contains(word):
-                # 0 or 1 feature space
-                features[self.indexer.index_of(word)] = 1
-            else:
-                if add_to_indexer:
-                    features[self.indexer.add_and_get_index(word)] = 1
-        return features
+    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> np.ndarray:
+        lc = [word.lower() for word in sentence] # lowercase
+        return _binary_features(_index_features(self.indexer, lc, add_to_indexer))
 
 
 
 
 class BigramFeatureExtractor(FeatureExtractor):
     """
-    Bigram feature extractor analogous to the unigram one.
+    Bigram feature extractor analogous to the unigram one. Bigrams are keyed by their packed pair of word ids; the
+    word ids come from a private vocabulary, so the feature indexer holds only bigram keys and its size is exactly the
+    number of features (unlike BetterFeatureExtractor, words are not features here).
     """
 
     def __init__(self, indexer: Indexer):
         self.indexer = indexer
+        # lowercased word -> word id, used only to build the bigram keys
+        self._word_ids = Indexer()
 
     def get_indexer(self):
         return self.indexer
 
-    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> Counter:
-        features = Counter()
-        for i in range(len(sentence)-1):
-            bigram = sentence[i] + " " + sentence[i+1]
-            bigram = bigram.lower()
-            if self.indexer.contains(bigram):
-                # 0 or 1 feature space
-                features[self.indexer.index_of(bigram)] = 1
-            else:
-                if add_to_indexer:
-                    features[self.indexer.add_and_get_index(bigram)] = 1
-        return features
+    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> np.ndarray:
+        ids = _token_ids(self._word_ids, [word.lower() for word in sentence], add_to_indexer)
+        # key each bigram by its packed pair of word ids rather than a "w1 w2" string. A bigram with an unseen word
+        # can't be in the indexer either, so those are skipped outright
+        bigrams = [(a << 32) | b for a, b in zip(ids, ids[1:]) if a >= 0 and b >= 0]
+        return _binary_features(_index_features(self.indexer, bigrams, add_to_indexer))
 
 
 
 
 class BetterFeatureExtractor(FeatureExtractor):
     """
-    Better feature extractor...try whatever you can think of!
+    Unigram, bigram and trigram features together, extracted in a single pass over the sentence. Unigram features are
+    the lowercased words themselves, and their indices double as the word ids that the n-gram keys are packed from.
     """
 
+    # Bigram keys (a << 32) | b stay below 2^64 while word ids fit in 32 bits, so setting bit 96 keeps trigram keys
+    # from ever colliding with them in the shared indexer
+    _TRIGRAM_TAG = 1 << 96
+
     def __init__(self, indexer: Indexer):
         self.indexer = indexer
 
     def get_indexer(self):
         return self.indexer
 
-    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> Counter:
-        features = Counter()
-        for i in range(len(sentence) - 2):
-            trigram = sentence[i] + " " + sentence[i + 1] + " " + sentence[i+2]
-            trigram = trigram.lower()
-            if self.indexer.contains(trigram):
-                # 0 or 1 feature space
-                features[self.indexer.index_of(trigram)] = 1
-            else:
-                if add_to_indexer:
-                    features[self.indexer.add_and_get_index(trigram)] = 1
-        return features
+    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> np.ndarray:
+        ids = _token_ids(self.indexer, [word.lower() for word in sentence], add_to_indexer)
+        ngrams = []
+        for i in range(1, len(ids)):
+            a, b = ids[i-1], ids[i]
+            # an n-gram with an unseen word can't be in the indexer either
+            if a < 0 or b < 0:
+                continue
+            ngrams.append((a << 32) | b)
+            if i > 1 and ids[i-2] >= 0:
+                ngrams.append(self._TRIGRAM_TAG | (ids[i-2] << 64) | (a << 32) | b)
+        return _binary_features([i for i in ids if i >= 0] + _index_features(self.indexer, ngrams, add_to_indexer))
+
+
+class HashingFeatureExtractor(FeatureExtractor):
+    """
+    Unigram bag-of-words features indexed by hashing the lowercased word into a fixed number of buckets instead of
+    going through an Indexer, as in scikit-learn's HashingVectorizer. There is no vocabulary to grow, so
+    add_to_indexer is ignored and the weight vector can be sized up front.
+    """
+
+    def __init__(self, num_buckets: int = 2 ** 20):
+        # power of two so the bucket is just the low bits of the hash
+        if num_buckets <= 0 or num_buckets & (num_buckets - 1) != 0:
+            raise Exception("num_buckets must be a power of two, got %i" % num_buckets)
+        self.num_buckets = num_buckets
+
+    def get_indexer(self):
+        return None
+
+    def feature_dim(self) -> int:
+        return self.num_buckets
+
+    def extract_features(self, sentence: List[str], add_to_indexer: bool = False) -> np.ndarray:
+        mask = self.num_buckets - 1
+        # crc32 rather than hash() so buckets don't change with PYTHONHASHSEED between runs
+        ids = [zlib.crc32(word.lower().encode()) & mask for word in sentence]
+        return _binary_features(ids)
 
 
 class SentimentClassifier(object):
@@ -143,17 +212,27 @@ class PerceptronClassifier(SentimentClassifier):
     modify the constructor to pass these in.
     """
 
-    def __init__(self, weight_vector, featurizer):
-        self.weight_vector = weight_vector
+    def __init__(self, weight_counts, featurizer):
+        """
+        :param weight_counts: int32 net perceptron update count of each feature; the trained weights are the step size
+        times these. Only the sign of the score matters at prediction time and the step size is positive, so it drops
+        out and the classifier keeps just the counts, as the int8 vector weight_counts_q
+        :param featurizer: feature extractor the counts were trained with
+        """
         self.featurizer = featurizer
+        weight_counts = np.asarray(weight_counts)
+        max_abs = int(np.abs(weight_counts).max()) if len(weight_counts) > 0 else 0
+        if max_abs <= 127:
+            # int8 holds the counts exactly
+            self.weight_counts_q = weight_counts.astype(np.int8)
+        else:
+            # rescale to fit; this is the only case where quantization can change a prediction
+            self.weight_counts_q = np.round(weight_counts * (127.0 / max_abs)).astype(np.int8)
 
     def predict(self, sentence: List[str]) -> int:  #FIXME: implement this
         features = self.featurizer.extract_features(sentence)
-        predicted_val = 0
-
-        for f in features:
-            predicted_val += features[f]*self.weight_vector[f]
-
+        # features are binary, so the dot product is just the sum of the active weights
+        predicted_val = int(self.weight_counts_q[features].sum(dtype=np.int32))
 
         if predicted_val > 0:
             return 1
@@ -183,24 +262,83 @@ class LogisticRegressionClassifier(SentimentClassifier):
 
     def p_1_x(self, sentence):
         features = self.featurizer.extract_features(sentence)
-        p_1_x = 0
-        for f in features:
-            p_1_x += features[f]*self.weight_vector[f] #w_t_fx
-        p_1_x = math.exp(p_1_x) / (1+math.exp(p_1_x))
-        return p_1_x
+        return self.p_1_from_score(float(self.weight_vector[features].sum())) #w_t_fx
 
-    def p_1_neg_x(self, sentence):
-        features = self.featurizer.extract_features(sentence)
-        P_1_NEG_X = 0
-        for f in features:
-            P_1_NEG_X += features[f]*self.weight_vector[f] #w_t_fx
+    def p_1_from_score(self, score: float) -> float:
+        """
+        :param score: w^T f(x), already computed by the caller
+        :return: P(y=1|x); P(y=0|x) is just 1 minus this
+        """
+        return float(expit(score)) # same stable sigmoid the trainer uses
 
-        P_1_NEG_X = 1/(1+math.exp(P_1_NEG_X))
-        return P_1_NEG_X
 
 
+def _featurize_examples(exs: List[SentimentExample], feat_extractor: FeatureExtractor):
+    """
+    Featurizes a whole training set in one pass, growing the indexer as needed, so the training loops never have to
+    re-extract features epoch after epoch.
+    :param exs: training set, List of SentimentExample objects
+    :param feat_extractor: feature extractor to use
+    :return: (X, y) where X is a scipy.sparse csr_matrix of shape (len(exs), feature_dim()) whose row i holds the
+    features of exs[i], and y is an int8 numpy array of the labels
+    """
+    all_features = [feat_extractor.extract_features(ex.words, True) for ex in exs] # cuz we are 'training'
+
+    indptr = np.zeros(len(exs) + 1, dtype=np.int32)
+    np.cumsum([len(features) for features in all_features], out=indptr[1:])
+    cols = np.concatenate(all_features) if all_features else np.zeros(0, dtype=np.int32)
+    # the indexer is complete at this point, so the weight vector can be allocated once at its final size
+    X = sp.csr_matrix((np.ones(len(cols), dtype=np.float32), cols, indptr),
+                      shape=(len(exs), feat_extractor.feature_dim()))
+    y = np.asarray([ex.label for ex in exs], dtype=np.int8)
+    return X, y
+
+
+def _perceptron_epoch_scalar(indices, indptr, y, sign, order, weight_counts) -> int:
+    """
+    One perceptron epoch over the rows of a CSR matrix, given by its indices/indptr arrays. Written with scalar loops
+    only so numba can compile it to native code.
+    :param indices: CSR column indices (the active features of every example, back to back)
+    :param indptr: CSR row pointers; example i's features are indices[indptr[i]:indptr[i+1]]
+    :param y: labels, 0 or 1
+    :param sign: +1 for positive examples, -1 for negative ones
+    :param order: the order in which to visit the examples
+    :param weight_counts: int32 net update count of each feature, updated in place
+    :return: number of mistakes made during the epoch
+    """
+    mistakes = 0
+    for i in order:
+        score = 0
+        for k in range(indptr[i], indptr[i+1]):
+            score += weight_counts[indices[k]]
+        predicted_val = 1 if score > 0 else 0
+        if y[i] == predicted_val:
+            continue
+        mistakes += 1
+        for k in range(indptr[i], indptr[i+1]):
+            weight_counts[indices[k]] += sign[i]
+    return mistakes
+
+
+def _perceptron_epoch_numpy(indices, indptr, y, sign, order, weight_counts) -> int:
+    """
+    Same as _perceptron_epoch_scalar, but vectorized per example with numpy fancy indexing, which is much faster than
+    the scalar loops when they can't be compiled.
+    """
+    mistakes = 0
+    for i in order:
+        cols = indices[indptr[i]:indptr[i+1]]
+        predicted_val = 1 if weight_counts[cols].sum() > 0 else 0
+        if y[i] == predicted_val:
+            continue
+        mistakes += 1
+        # features within a sentence are unique, so plain fancy-index += is safe (no need for np.add.at)
+        weight_counts[cols] += sign[i]
+    return mistakes
 
 
+_run_perceptron_epoch = njit(cache=True)(_perceptron_epoch_scalar) if njit is not None else _perceptron_epoch_numpy
+
 
 # FIXME: Part 1. PERCEPTRON
 def train_perceptron(train_exs: List[SentimentExample], feat_extractor: FeatureExtractor) -> PerceptronClassifier:
@@ -210,31 +348,22 @@ def train_perceptron(train_exs: List[SentimentExample], feat_extractor: FeatureE
     :param feat_extractor: feature extractor to use
     :return: trained PerceptronClassifier model
     """
-    random.seed(10)
-    alpha = 0.05 #FIXME: arbitrary choice
+    np.random.seed(10)
     epochs = 50 #FIXME: arbitrary choice
-    weight_vector = [0 for i in range(len(feat_extractor.get_indexer()))]
-
-    perceptron_classifier = PerceptronClassifier(weight_vector, feat_extractor)
+    X, y = _featurize_examples(train_exs, feat_extractor)
+    sign = (2 * y.astype(np.int32) - 1) # +1 for positive examples, -1 for negative ones
+    # Starting from zero, every update adds +-alpha, so the weights are always alpha times an integer and the step size
+    # never changes a prediction. Training on the integer counts keeps scores exact: no float rounding decides a tie at
+    # 0, and the compiled and numpy loops give identical weights
+    weight_counts = np.zeros(X.shape[1], dtype=np.int32)
+
+    order = np.arange(len(train_exs))
     for e in range(epochs):
-        random.shuffle(train_exs)
-        for train_ex in train_exs:
-            if train_ex.label == perceptron_classifier.predict(train_ex.words):
-                continue
-            else:
-                features = feat_extractor.extract_features(train_ex.words, True) # cuz we are 'training'
-                for i in range(len(feat_extractor.get_indexer()) - len(perceptron_classifier.weight_vector)):
-                    perceptron_classifier.weight_vector.append(0)
-                perceptron_classifier.weight_vector.append(0)
-                if train_ex.label == 1:
-                    for word_idx in features:
-                        perceptron_classifier.weight_vector[word_idx] += alpha * features[word_idx]
-                elif train_ex.label == 0:
-                    for word_idx in features:
-                        perceptron_classifier.weight_vector[word_idx] -= alpha * features[word_idx]
-                else:
-                    print("This should not happen")
-    return perceptron_classifier
+        np.random.shuffle(order)
+        if _run_perceptron_epoch(X.indices, X.indptr, y, sign, order, weight_counts) == 0:
+            # converged: a clean pass means every later epoch would leave the weights untouched
+            break
+    return PerceptronClassifier(weight_counts, feat_extractor)
 
 
 
@@ -246,31 +375,25 @@ def train_logistic_regression(train_exs: List[SentimentExample],
     :param feat_extractor: feature extractor to use
     :return: trained LogisticRegressionClassifier model
     """
-    random.seed(2324) #FIXME: return here
-    alpha = 0.1
+    np.random.seed(2324) #FIXME: return here
+    alpha = 2.0 # step size for the batch-averaged gradient
     epochs = 15
-    weight_vector = [0 for i in range(len(feat_extractor.get_indexer()))]
+    batch_size = 64
+    X, y = _featurize_examples(train_exs, feat_extractor)
+    y = y.astype(np.float32)
+    weight_vector = np.zeros(X.shape[1], dtype=np.float32)
 
-    lr_classifier = LogisticRegressionClassifier(weight_vector, feat_extractor)
     for e in range(epochs):
-        random.shuffle(train_exs)
-        for train_ex in train_exs:
-            features = feat_extractor.extract_features(train_ex.words, True)  # cuz we are 'training'
-            for i in range(len(feat_extractor.get_indexer()) - len(lr_classifier.weight_vector)):
-                lr_classifier.weight_vector.append(0)
-
-            lr_classifier.weight_vector.append(0)
-            if train_ex.label == 1:
-                if lr_classifier.predict(train_ex.words) == 1:
-                    continue
-                for f in features:
-                    weight_vector[f] += alpha*(1-lr_classifier.p_1_x(train_ex.words))
-            else:
-                if lr_classifier.predict(train_ex.words) == 0:
-                    continue
-                for f in features:
-                    weight_vector[f] -= alpha*(1-lr_classifier.p_1_neg_x(train_ex.words))
-    return lr_classifier
+        order = np.random.permutation(len(train_exs))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            X_batch = X[batch]
+            p_1_x = expit(X_batch.dot(weight_vector)) # stable vectorized sigmoid
+            # gradient of the log likelihood: sum over the batch of (y - P(y=1|x)) * f(x). Scatter it onto just the
+            # batch's active features; X_batch.T.dot() would build a dense vector as long as the whole feature space
+            residual = np.repeat(y[batch] - p_1_x, np.diff(X_batch.indptr))
+            np.add.at(weight_vector, X_batch.indices, (alpha / len(batch)) * residual * X_batch.data)
+    return LogisticRegressionClassifier(weight_vector, feat_extractor)
 
 
 
@@ -296,8 +419,10 @@ def train_model(args, train_exs: List[SentimentExample], dev_exs: List[Sentiment
     elif args.feats == "BETTER":
         # Add additional preprocessing code here
         feat_extractor = BetterFeatureExtractor(Indexer())
+    elif args.feats == "HASH":
+        feat_extractor = HashingFeatureExtractor()
     else:
-        raise Exception("Pass in UNIGRAM, BIGRAM, or BETTER to run the appropriate system")
+        raise Exception("Pass in UNIGRAM, BIGRAM, BETTER, or HASH to run the appropriate system")
 
     # Train the model
     if args.model == "TRIVIAL":
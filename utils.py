@@ -28,10 +28,7 @@ class Indexer(object):
         :param index: integer index to look up
         :return: Returns the object corresponding to the particular index or None if not found
         """
-        if (index not in self.ints_to_objs):
-            return None
-        else:
-            return self.ints_to_objs[index]
+        return self.ints_to_objs.get(index)
 
     def contains(self, object):
         """
@@ -45,10 +42,7 @@ class Indexer(object):
         :param object: object to look up
         :return: Returns -1 if the object isn't present, index otherwise
         """
-        if (object not in self.objs_to_ints):
-            return -1
-        else:
-            return self.objs_to_ints[object]
+        return self.objs_to_ints.get(object, -1)
 
     def add_and_get_index(self, object, add=True):
         """
@@ -59,11 +53,13 @@ class Indexer(object):
         """
         if not add:
             return self.index_of(object)
-        if (object not in self.objs_to_ints):
-            new_idx = len(self.objs_to_ints)
-            self.objs_to_ints[object] = new_idx
-            self.ints_to_objs[new_idx] = object
-        return self.objs_to_ints[object]
+        # single dict probe on the (common) hit path
+        idx = self.objs_to_ints.get(object)
+        if idx is None:
+            idx = len(self.objs_to_ints)
+            self.objs_to_ints[object] = idx
+            self.ints_to_objs[idx] = object
+        return idx
 
 
 class Beam(object):